@@ -1,18 +1,30 @@
 # upload_service.py
 import os
 import time
+import heapq
+import asyncio
+import functools
+import hashlib
+import logging
 import threading
-from typing import Optional, Dict
+import contextlib
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Tuple
 
 from fastapi import FastAPI, File, UploadFile, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse, Response, PlainTextResponse
+from fastapi.responses import HTMLResponse, Response, PlainTextResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.concurrency import run_in_threadpool
+import orjson
 from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 import cloudinary
 import cloudinary.uploader
+import cloudinary.utils
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # -------- .env ----------
 load_dotenv()
@@ -21,6 +33,10 @@ CLOUD_NAME = os.getenv("CLOUDINARY_CLOUD_NAME")
 API_KEY = os.getenv("CLOUDINARY_API_KEY")
 API_SECRET = os.getenv("CLOUDINARY_API_SECRET")
 UPLOAD_PRESET = os.getenv("CLOUDINARY_UPLOAD_PRESET", "mindfulpro")
+UPLOAD_CHUNK_SIZE = 6_000_000  # bytes por parte en upload_large
+# Formatos aceptados en la subida directa; va firmado para que la firma no
+# sirva en /raw/upload ni /video/upload
+ALLOWED_FORMATS = "jpg,jpeg,png,gif,webp,heic"
 
 # OneSignal
 ONESIGNAL_APP_ID = os.getenv("ONESIGNAL_APP_ID")  # usa el que te funciona
@@ -30,58 +46,355 @@ if not (CLOUD_NAME and API_KEY and API_SECRET):
 
 cloudinary.config(cloud_name=CLOUD_NAME, api_key=API_KEY, api_secret=API_SECRET, secure=True)
 
-app = FastAPI(title="Mindful Service")
-templates = Jinja2Templates(directory="templates")
+# El SDK usa un PoolManager de urllib3 a nivel de módulo, pero con una sola
+# conexión por host: con varias subidas en paralelo (threadpool) las demás se
+# abren y se tiran. Lo reemplazamos por uno con más conexiones reutilizables.
+CLOUDINARY_POOL_MAXSIZE = 32
+cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+    cloudinary.config(),
+    dict(cloudinary.CERT_KWARGS, maxsize=CLOUDINARY_POOL_MAXSIZE),
+)
+
+# ---------- Sesiones ----------
+# Con REDIS_URL se guardan en Redis y las ven todos los workers; sin él se usa
+# el almacén en memoria, válido sólo con un proceso. Ambos exponen la misma
+# interfaz (set/get/touch/notify_ready/start) y se elige uno solo al importar.
+SESSION_TTL = 60*30
+POLL_TIMEOUT = 25  # segundos que /poll retiene la petición esperando la URL
+REDIS_URL = os.getenv("REDIS_URL")
+
+logger = logging.getLogger(__name__)
+
+# Eventos locales para despertar a los /poll en espera cuando llega la URL.
+# Los /poll de una misma sesión comparten el evento; _waiters cuenta cuántos
+# esperan para quitarlo sólo cuando sale el último.
+_events: Dict[str, asyncio.Event] = {}
+_waiters: Dict[str, int] = {}
+
+def _wake(session_id: str):
+    ev = _events.get(session_id)
+    if ev is not None:
+        ev.set()
+
+class Session:
+    __slots__ = ("ts", "url", "urls", "push_ready")
+
+    def __init__(self, ts: float):
+        self.ts = ts
+        self.url = None
+        self.urls = None
+        self.push_ready = False
+
+class MemoryStore:
+    """Sesiones en memoria del proceso.
+
+    Repartidas en shards con un lock cada uno para no serializar todas las
+    peticiones en un lock global. Sólo las escrituras toman el lock; las lecturas
+    confían en que dict.get es atómico en CPython.
+    Cada shard lleva además un heap (expira_en, session_id) para que el janitor
+    sólo revise las entradas vencidas. Las entradas viejas del heap se descartan
+    al sacarlas comparando contra el ts actual de la sesión.
+    """
+
+    N_SHARDS = 16
+
+    def __init__(self):
+        self._shards: List[Dict[str, Session]] = [{} for _ in range(self.N_SHARDS)]
+        self._expiry: List[List[Tuple[float, str]]] = [[] for _ in range(self.N_SHARDS)]
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(self.N_SHARDS)]
+        # El janitor arranca aquí y no en el lifespan, para que las sesiones
+        # expiren también con --lifespan off o montado como sub-app
+        threading.Thread(target=self._janitor, daemon=True).start()
+
+    def _shard_index(self, session_id: str) -> int:
+        return hash(session_id) & (self.N_SHARDS - 1)
+
+    def _get_or_create(self, i: int, session_id: str, now: float) -> Session:
+        # Llamar con _locks[i] tomado
+        s = self._shards[i].get(session_id)
+        if s is None:
+            s = self._shards[i][session_id] = Session(now)
+        return s
+
+    async def set(self, session_id: str, key: str, value):
+        await self.set_many(session_id, {key: value})
+
+    async def set_many(self, session_id: str, values: Dict[str, object]):
+        now = time.time()
+        i = self._shard_index(session_id)
+        with self._locks[i]:
+            s = self._get_or_create(i, session_id, now)
+            for key, value in values.items():
+                setattr(s, key, value)
+            s.ts = now
+            heapq.heappush(self._expiry[i], (now + SESSION_TTL, session_id))
+
+    async def get(self, session_id: str, key: str):
+        s = self._shards[self._shard_index(session_id)].get(session_id)
+        return getattr(s, key) if s is not None else None
+
+    async def get_many(self, session_id: str, keys: Tuple[str, ...]) -> List:
+        s = self._shards[self._shard_index(session_id)].get(session_id)
+        return [getattr(s, key) if s is not None else None for key in keys]
+
+    async def touch(self, session_id: str):
+        now = time.time()
+        i = self._shard_index(session_id)
+        with self._locks[i]:
+            self._get_or_create(i, session_id, now).ts = now
+            heapq.heappush(self._expiry[i], (now + SESSION_TTL, session_id))
+
+    async def notify_ready(self, session_id: str):
+        _wake(session_id)
+
+    def _janitor(self):
+        while True:
+            time.sleep(60)
+            now = time.time()
+            for shard, heap, lock in zip(self._shards, self._expiry, self._locks):
+                with lock:
+                    while heap and heap[0][0] <= now:
+                        _, sid = heapq.heappop(heap)
+                        s = shard.get(sid)
+                        if s is not None and s.ts + SESSION_TTL <= now:
+                            del shard[sid]
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class RedisStore:
+    """Sesiones en Redis, compartidas entre workers.
+
+    Un hash por sesión (s:<id>) con EXPIRE; los valores van serializados en JSON.
+    El aviso de "URL lista" se publica en ready:<id> y un suscriptor por proceso
+    lo reenvía a los eventos locales.
+    """
+
+    READY_CHANNEL = "ready:"
+
+    def __init__(self, url: str):
+        import redis.asyncio as aioredis
+
+        self._redis = aioredis.Redis.from_url(url, decode_responses=True)
+        self._listener: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"s:{session_id}"
+
+    async def set(self, session_id: str, key: str, value):
+        await self.set_many(session_id, {key: value})
+
+    async def set_many(self, session_id: str, values: Dict[str, object]):
+        # Un solo HSET: los campos se ven juntos desde cualquier worker
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self._key(session_id), mapping={k: orjson.dumps(v) for k, v in values.items()})
+            pipe.expire(self._key(session_id), SESSION_TTL)
+            await pipe.execute()
+
+    async def get(self, session_id: str, key: str):
+        raw = await self._redis.hget(self._key(session_id), key)
+        return orjson.loads(raw) if raw is not None else None
+
+    async def get_many(self, session_id: str, keys: Tuple[str, ...]) -> List:
+        raws = await self._redis.hmget(self._key(session_id), keys)
+        return [orjson.loads(raw) if raw is not None else None for raw in raws]
+
+    async def touch(self, session_id: str):
+        await self.set(session_id, "ts", time.time())
+
+    async def notify_ready(self, session_id: str):
+        await self._redis.publish(self.READY_CHANNEL + session_id, "1")
+
+    async def _ready_listener(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.psubscribe(self.READY_CHANNEL + "*")
+                async for msg in pubsub.listen():
+                    if msg["type"] == "pmessage":
+                        _wake(msg["channel"][len(self.READY_CHANNEL):])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Sin suscriptor los /poll de otros workers esperan todo el timeout
+                logger.exception("Falló la suscripción a Redis; reintentando")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def start(self):
+        self._listener = asyncio.create_task(self._ready_listener())
+
+    async def stop(self):
+        # Se espera al listener para que su aclose() corra antes de cerrar el loop
+        if self._listener is not None:
+            self._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+        await self._redis.aclose()
+
+_store = RedisStore(REDIS_URL) if REDIS_URL else MemoryStore()
+session_set = _store.set
+session_set_many = _store.set_many
+session_get = _store.get
+session_get_many = _store.get_many
+touch_session = _store.touch
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Con Redis arranca el suscriptor que despierta a los /poll de este
+    # proceso; el almacén en memoria no necesita nada aquí.
+    _store.start()
+    yield
+    await _store.stop()
+
+app = FastAPI(title="Mindful Service", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Plantillas con caché de bytecode en disco; se compilan al importar para que
+# la primera petición de cada worker no pague el parseo. Sin JINJA_CACHE_DIR se
+# usa el directorio por defecto de Jinja (privado por usuario, 0700 y con dueño
+# verificado); un directorio compartido permitiría inyectar bytecode.
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR")
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, mode=0o700, exist_ok=True)
+_jinja_env = Environment(
+    loader=FileSystemLoader(os.path.join(BASE_DIR, "templates")),
+    bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR),
+    auto_reload=False,
+    autoescape=True,
+)
+templates = Jinja2Templates(env=_jinja_env)
+_TEMPLATE_NAMES = ("upload.html", "notify.html")
+for _name in _TEMPLATE_NAMES:
+    _jinja_env.get_template(_name)
+
+# Huella de las plantillas: forma parte de los ETag de las páginas para que un
+# despliegue con HTML nuevo no se quede oculto tras un 304.
+_TEMPLATES_HASH = hashlib.md5(
+    "".join(_jinja_env.loader.get_source(_jinja_env, n)[0] for n in _TEMPLATE_NAMES).encode()
+).hexdigest()
+
+def _page_etag(*parts: str) -> str:
+    return '"%s"' % hashlib.md5("\0".join((_TEMPLATES_HASH,) + parts).encode()).hexdigest()
+
+def _page_headers(etag: str) -> Dict[str, str]:
+    # no-cache: el navegador guarda la página pero revalida con If-None-Match
+    return {"ETag": etag, "Cache-Control": "no-cache"}
 
 
 # ---------- Headers para iframe embebido ----------
-class FrameHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers["X-Frame-Options"] = "ALLOWALL"
-        response.headers["Content-Security-Policy"] = "frame-ancestors *"
-        return response
+# Middleware ASGI puro: evita la tarea extra y el buffering de BaseHTTPMiddleware.
+FRAME_HEADERS = [
+    (b"x-frame-options", b"ALLOWALL"),
+    (b"content-security-policy", b"frame-ancestors *"),
+]
+
+class FrameHeadersMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + FRAME_HEADERS
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
 
 app.add_middleware(FrameHeadersMiddleware)
 
+# ---------- Límite de tamaño en /upload ----------
+# Rechaza con 413 antes de leer el cuerpo si Content-Length excede el máximo.
+# Si no viene Content-Length (chunked) cuenta los bytes recibidos: al pasar el
+# máximo la app ve una desconexión, se descarta su respuesta y se manda el 413.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES, path: str = "/upload"):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path = path
+
+    async def _reject(self, scope, receive, send):
+        response = ORJSONResponse(
+            status_code=413,
+            content={"ok": False, "error": "Archivo demasiado grande"},
+        )
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.app(scope, receive, send)
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    too_big = int(value) > self.max_bytes
+                except ValueError:
+                    too_big = False
+                if too_big:
+                    return await self._reject(scope, receive, send)
+                break
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def receive_wrapper():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def send_wrapper(message):
+            nonlocal started
+            if exceeded:
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not started:
+            await self._reject(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # ---------- CORS ----------
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # ajusta en producción
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_credentials=False,  # no usamos cookies; así se responde con "*" fijo
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
 )
 
-# ---------- Sesiones en memoria ----------
-_sessions: Dict[str, Dict] = {}
-_lock = threading.Lock()
+async def publish_url(session_id: str, urls: List[str]):
+    """Guarda las URLs de la sesión y despierta a los /poll que las esperan.
 
-def session_set(session_id: str, key: str, value):
-    with _lock:
-        _sessions.setdefault(session_id, {"ts": time.time()})
-        _sessions[session_id][key] = value
-        _sessions[session_id]["ts"] = time.time()
-
-def session_get(session_id: str, key: str):
-    with _lock:
-        return (_sessions.get(session_id) or {}).get(key)
-
-def touch_session(session_id: str):
-    with _lock:
-        _sessions.setdefault(session_id, {"ts": time.time()})
-        _sessions[session_id]["ts"] = time.time()
-
-def janitor():
-    while True:
-        time.sleep(60)
-        cutoff = time.time() - 60*30
-        with _lock:
-            for k in list(_sessions.keys()):
-                if _sessions[k]["ts"] < cutoff:
-                    del _sessions[k]
-
-threading.Thread(target=janitor, daemon=True).start()
+    "url" es la primera de "urls"; se escriben en una sola operación (y /poll
+    las lee igual) para que nunca queden de subidas distintas.
+    """
+    await session_set_many(session_id, {"urls": urls, "url": urls[0]})
+    await _store.notify_ready(session_id)
 
 # ---------- Rutas básicas ----------
 @app.get("/health")
@@ -90,19 +403,45 @@ def health():
 
 # --------- (CRÍTICO) Service Worker en RAÍZ para Chrome ----------
 # OneSignal v16 espera que este archivo esté disponible en /OneSignalSDKWorker.js
-ONESIGNAL_SW_JS = "importScripts('https://cdn.onesignal.com/sdks/web/v16/OneSignalSDK.sw.js');"
+# Sólo se registran si los archivos están junto a este módulo. Se leen una vez
+# al arrancar y se sirven desde memoria con ETag para permitir caché.
+STATIC_DIR = BASE_DIR
+SW_WORKER_PATH = os.path.join(STATIC_DIR, "OneSignalSDKWorker.js")
+SW_UPDATER_PATH = os.path.join(STATIC_DIR, "OneSignalSDKUpdaterWorker.js")
+SW_CACHE_CONTROL = "public, max-age=86400"
+
+def _load_js(path: str) -> Tuple[bytes, Dict[str, str]]:
+    with open(path, "rb") as f:
+        body = f.read()
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    return body, {"ETag": etag, "Cache-Control": SW_CACHE_CONTROL}
 
-@app.get("/OneSignalSDKWorker.js")
-def onesignal_worker_js():
-    # content-type correcto y sin caché agresiva mientras depuras
-    return Response(content=ONESIGNAL_SW_JS, media_type="application/javascript", headers={
-        "Cache-Control": "no-store"
-    })
+def _cached_js(request: Request, body: bytes, headers: Dict[str, str]) -> Response:
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/javascript", headers=headers)
+
+if os.path.exists(SW_WORKER_PATH):
+    _SW_BYTES, _SW_HEADERS = _load_js(SW_WORKER_PATH)
+
+    @app.get("/OneSignalSDKWorker.js")
+    def onesignal_worker(request: Request):
+        return _cached_js(request, _SW_BYTES, _SW_HEADERS)
+
+if os.path.exists(SW_UPDATER_PATH):
+    _SW_UPDATER_BYTES, _SW_UPDATER_HEADERS = _load_js(SW_UPDATER_PATH)
+
+    @app.get("/OneSignalSDKUpdaterWorker.js")
+    def onesignal_worker_updater(request: Request):
+        return _cached_js(request, _SW_UPDATER_BYTES, _SW_UPDATER_HEADERS)
 
 # ---------- Uploader ----------
 @app.get("/uploader", response_class=HTMLResponse)
-def uploader_form(request: Request, session: str, folder: str = "mindful/profesionistas"):
-    touch_session(session)
+async def uploader_form(request: Request, session: str, folder: str = "mindful/profesionistas"):
+    await touch_session(session)
+    headers = _page_headers(_page_etag(session, folder, CLOUD_NAME, UPLOAD_PRESET))
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
     return templates.TemplateResponse(
         "upload.html",
         {
@@ -112,60 +451,145 @@ def uploader_form(request: Request, session: str, folder: str = "mindful/profesi
             "session": session,
             "folder": folder,
         },
+        headers=headers,
     )
 
+# El navegador sube directo a Cloudinary con estos parámetros firmados y
+# después avisa la URL resultante en /notify_url; el archivo no pasa por aquí.
+@app.get("/sign")
+def sign(folder: str = "mindful/profesionistas"):
+    params = {
+        "timestamp": int(time.time()),
+        "folder": folder,
+        "upload_preset": UPLOAD_PRESET,
+        "allowed_formats": ALLOWED_FORMATS,
+    }
+    params["signature"] = cloudinary.utils.api_sign_request(params, API_SECRET)
+    params["api_key"] = API_KEY
+    return params
+
+@app.post("/notify_url")
+async def notify_url(session: str, url: str):
+    # Sólo aceptamos URLs de nuestra propia cuenta de Cloudinary
+    if not url.startswith(f"https://res.cloudinary.com/{CLOUD_NAME}/"):
+        return ORJSONResponse(status_code=400, content={"ok": False, "error": "URL no válida"})
+    await publish_url(session, [url])
+    return {"ok": True}
+
+# Parámetros fijos de la subida ya aplicados una sola vez
+_do_upload = functools.partial(
+    cloudinary.uploader.upload_large,
+    chunk_size=UPLOAD_CHUNK_SIZE,
+    upload_preset=UPLOAD_PRESET,
+    resource_type="image",
+)
+
+async def _upload_one(file: UploadFile, **params):
+    # Se pasa el SpooledTemporaryFile directo: upload_large lo envía por
+    # partes sin copiar el archivo completo a memoria.
+    await file.seek(0)
+    return await run_in_threadpool(_do_upload, file.file, **params)
+
 @app.post("/upload")
 async def upload_image(
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(default=None),
+    files: Optional[List[UploadFile]] = File(default=None),
     session: Optional[str] = Form(default=None),
     folder: Optional[str] = Form(default="mindful/profesionistas"),
     public_id: Optional[str] = Form(default=None),
     overwrite: Optional[bool] = Form(default=True),
 ):
+    # Acepta uno ("file") o varios ("files"); varios se suben en paralelo.
+    # public_id sólo aplica cuando se sube un único archivo.
+    uploads = ([file] if file else []) + (files or [])
+    if not uploads:
+        return ORJSONResponse(status_code=400, content={"ok": False, "error": "Falta el archivo"})
+    if len(uploads) > 1:
+        public_id = None
     try:
-        contents = await file.read()
-        res = cloudinary.uploader.upload(
-            contents,
-            folder=folder,
-            public_id=public_id,
-            overwrite=overwrite,
-            upload_preset=UPLOAD_PRESET,
-            resource_type="image",
-        )
-        url = res.get("secure_url")
-        if session and url:
-            session_set(session, "url", url)
-        return {"ok": True, "secure_url": url, "public_id": res.get("public_id")}
+        results = await asyncio.gather(*[
+            _upload_one(f, folder=folder, public_id=public_id, overwrite=overwrite)
+            for f in uploads
+        ])
+        # Se publican las que sí regresaron URL, aunque falte la del primero
+        done = [res for res in results if res.get("secure_url")]
+        if session and done:
+            await publish_url(session, [res["secure_url"] for res in done])
+        return {
+            "ok": True,
+            "secure_url": done[0]["secure_url"] if done else None,
+            "public_id": done[0].get("public_id") if done else None,
+            "results": [
+                {"secure_url": res.get("secure_url"), "public_id": res.get("public_id")}
+                for res in results
+            ],
+        }
     except Exception as ex:
-        return JSONResponse(status_code=400, content={"ok": False, "error": str(ex)})
+        return ORJSONResponse(status_code=400, content={"ok": False, "error": str(ex)})
 
 @app.get("/poll")
-def poll(session: str):
-    url = session_get(session, "url")
-    return {"ok": True, "url": url}
+async def poll(session: str):
+    # Long-poll: si aún no hay URL, espera hasta POLL_TIMEOUT a que /upload avise.
+    # El evento se registra antes de volver a consultar para no perder un aviso
+    # que llegue entre ambas cosas.
+    url, urls = await session_get_many(session, ("url", "urls"))
+    if url is None:
+        ev = _events.setdefault(session, asyncio.Event())
+        _waiters[session] = _waiters.get(session, 0) + 1
+        try:
+            url, urls = await session_get_many(session, ("url", "urls"))
+            if url is None:
+                try:
+                    await asyncio.wait_for(ev.wait(), timeout=POLL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                url, urls = await session_get_many(session, ("url", "urls"))
+        finally:
+            _waiters[session] -= 1
+            if not _waiters[session]:
+                del _waiters[session]
+                _events.pop(session, None)
+    return {"ok": True, "url": url, "urls": urls}
 
 # ---------- NOTIFICACIONES ----------
-@app.get("/notify", response_class=HTMLResponse)
-def notify_page(request: Request, session: str):
-    if not ONESIGNAL_APP_ID:
-        return HTMLResponse("<h3>Falta ONESIGNAL_APP_ID en el servidor.</h3>", status_code=500)
+# Sólo se exponen si hay ONESIGNAL_APP_ID configurado
+if ONESIGNAL_APP_ID:
+    # Plantilla y parte fija del contexto resueltas una sola vez
+    _notify_tpl = _jinja_env.get_template("notify.html")
+    _NOTIFY_BASE = {"onesignal_app_id": ONESIGNAL_APP_ID}
 
-    touch_session(session)
-    return templates.TemplateResponse(
-        "notify.html",
-        {
-            "request": request,
-            "onesignal_app_id": ONESIGNAL_APP_ID,
-            "session": session,
-        },
-    )
+    @app.get("/notify", response_class=HTMLResponse)
+    async def notify_page(request: Request, session: str):
+        await touch_session(session)
+        headers = _page_headers(_page_etag(session, ONESIGNAL_APP_ID))
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        ctx = {**_NOTIFY_BASE, "request": request, "session": session}
+        return HTMLResponse(_notify_tpl.render(ctx), headers=headers)
+
+    @app.post("/notify/ok")
+    async def notify_ok(session: str):
+        await session_set(session, "push_ready", True)
+        return {"ok": True}
+
+    @app.get("/notify/poll")
+    async def notify_poll(session: str):
+        ready = bool(await session_get(session, "push_ready"))
+        return {"ok": True, "ready": ready}
 
-@app.post("/notify/ok")
-def notify_ok(session: str):
-    session_set(session, "push_ready", True)
-    return {"ok": True}
 
-@app.get("/notify/poll")
-def notify_poll(session: str):
-    ready = bool(session_get(session, "push_ready"))
-    return {"ok": True, "ready": ready}
+# ---------- Arranque ----------
+# Runtime esperado: uvloop + httptools. Con loop/http en "auto" uvicorn los usa
+# si están instalados (uvloop no existe en Windows y ahí cae a asyncio), p. ej.:
+#   uvicorn uploader_service:app --loop uvloop --http httptools
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "uploader_service:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )